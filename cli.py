@@ -4,8 +4,14 @@ Command-line entry for sprite sheet processing: transparent background + M×N sp
 Supports batch and glob patterns (e.g. raw/*.png). Background: color-based or rembg.
 """
 import argparse
+import fnmatch
+import os
+import stat
 import sys
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
 
 # Unbuffered output so progress and logs show in real time (e.g. when run via conda run)
 getattr(sys.stdout, "reconfigure", lambda **kw: None)(line_buffering=True)
@@ -19,10 +25,16 @@ from src.process_sheet import (
     frames_to_gif,
     frames_to_mp4,
     make_background_transparent,
-    remove_background_rembg,
+    new_rembg_session,
+    remove_background_rembg_batch,
+    resolve_rembg_providers,
+    set_kernel_threads,
     split_into_frames,
 )
 
+if TYPE_CHECKING:
+    from rembg.sessions.base import BaseSession
+
 
 def parse_hex_color(s: str) -> tuple[int, int, int]:
     """Parse '#RRGGBB' or 'RRGGBB' to (r, g, b)."""
@@ -33,18 +45,35 @@ def parse_hex_color(s: str) -> tuple[int, int, int]:
 
 
 def expand_inputs(paths: list[Path]) -> list[Path]:
-    """Expand glob patterns (*, ?, []) in paths. Concrete file paths are kept as-is."""
+    """
+    Expand glob patterns (*, ?, []) in paths. Concrete file paths are kept as-is.
+    Each argument is stat()ed once; glob matches are filtered to regular files from the
+    directory listing (d_type), so directories and other entries are skipped without a stat().
+    """
     result: list[Path] = []
+    missing: list[Path] = []
     for p in paths:
-        if p.is_file():
+        try:
+            is_file = stat.S_ISREG(p.stat().st_mode)
+        except OSError:
+            is_file = False
+        if is_file:
             result.append(p)
         elif "*" in p.name or "?" in p.name or "[" in p.name:
-            matches = sorted(p.parent.glob(p.name))
+            try:
+                with os.scandir(p.parent) as it:
+                    matches = sorted(
+                        p.parent / e.name for e in it if fnmatch.fnmatch(e.name, p.name) and e.is_file()
+                    )
+            except OSError:
+                matches = []
             if not matches:
                 raise SystemExit(f"No files match pattern: {p}")
             result.extend(matches)
         else:
-            result.append(p)
+            missing.append(p)
+    if missing:
+        raise SystemExit(f"Input file(s) not found: {missing}")
     return result
 
 
@@ -54,14 +83,24 @@ def process_one(
     rows: int,
     cols: int,
     use_rembg: bool,
-    bg_rgb: tuple[int, int, int] | None,
+    bg_rgb: list[tuple[int, int, int]] | None,
     tolerance: int,
     save_full: bool,
     preview_duration_ms: int,
     preview_format: str,
     preview_checkerboard: bool,
+    compress_level: int = 6,
+    rembg_session: "BaseSession | None" = None,
+    frame_progress: bool = True,
+    save_threads: int | None = None,
 ) -> None:
-    """Process a single sprite sheet: transparent, split, save frames + preview."""
+    """
+    Process a single sprite sheet: transparent, split, save frames + preview.
+    compress_level: zlib level for frame/sheet PNGs (0-9; lower is faster, larger files).
+    rembg_session: shared across sheets so the rembg model is loaded once per run.
+    frame_progress: show the per-frame rembg progress bar (off in pool workers).
+    save_threads: threads for encoding frame PNGs; default CPU count (pool workers get a share).
+    """
     stem = input_path.stem
     frame_dir = output_base / stem
     # Ensure we never write outside output_base (path traversal safety)
@@ -71,20 +110,23 @@ def process_one(
         raise ValueError(f"Output path would escape output dir: {frame_dir}")
     frame_dir.mkdir(parents=True, exist_ok=True)
 
-    img = Image.open(input_path).convert("RGB")
+    # Decode once in the file's own mode; the transparency/rembg steps convert as they need
+    img: Image.Image = Image.open(input_path)
+    img.load()
 
     if use_rembg:
         # Split original, then rembg each frame (better quality than full-sheet rembg).
         raw_frames = split_into_frames(img, rows, cols)
-        frames = [
-            remove_background_rembg(f)
-            for f in tqdm(
+        frames = remove_background_rembg_batch(
+            tqdm(
                 raw_frames,
                 desc=f"  {stem} rembg",
                 unit="frame",
                 leave=False,
-            )
-        ]
+                disable=not frame_progress,
+            ),
+            session=rembg_session,
+        )
         if save_full:
             fw, fh = frames[0].size
             full = Image.new("RGBA", (fw * cols, fh * rows), (0, 0, 0, 0))
@@ -92,7 +134,7 @@ def process_one(
                 row, col = i // cols, i % cols
                 full.paste(frame, (col * fw, row * fh))
             full_path = frame_dir / f"{stem}_sheet.png"
-            full.save(full_path, "PNG")
+            full.save(full_path, "PNG", compress_level=compress_level)
             print(f"  Saved full sheet: {full_path}")
     else:
         if bg_rgb is None:
@@ -100,13 +142,15 @@ def process_one(
         img = make_background_transparent(img, bg_rgb, tolerance)
         if save_full:
             full_path = frame_dir / f"{stem}_sheet.png"
-            img.save(full_path, "PNG")
+            img.save(full_path, "PNG", compress_level=compress_level)
             print(f"  Saved full sheet: {full_path}")
         frames = split_into_frames(img, rows, cols)
 
-    for i, frame in enumerate(frames):
-        path = frame_dir / f"{stem}_{i + 1}.png"
-        frame.save(path, "PNG")
+    paths = [frame_dir / f"{stem}_{i + 1}.png" for i in range(len(frames))]
+    # PNG encoding (zlib) releases the GIL, so frames encode and write in parallel.
+    threads = save_threads if save_threads is not None else (os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(frames), threads))) as tp:
+        list(tp.map(lambda fp: fp[0].save(fp[1], "PNG", compress_level=compress_level), zip(frames, paths)))
     print(f"  Saved {len(frames)} frames to {frame_dir} ({stem}_1 .. {stem}_{len(frames)}).")
 
     preview_path = frame_dir / f"{stem}.{preview_format}"
@@ -121,7 +165,57 @@ def process_one(
     print(f"  Saved preview ({preview_format}): {preview_path}")
 
 
+class SheetJob(NamedTuple):
+    """Per-sheet positional arguments of process_one (picklable for the process pool)."""
+
+    input_path: Path
+    output_base: Path
+    rows: int
+    cols: int
+    use_rembg: bool
+    bg_rgb: list[tuple[int, int, int]] | None
+    tolerance: int
+    save_full: bool
+    preview_duration_ms: int
+    preview_format: str
+    preview_checkerboard: bool
+    compress_level: int
+
+
+# Pool workers' own rembg session (sessions cannot be pickled; created once per worker)
+# and their share of the CPU for inner thread pools.
+_worker_rembg_session: "BaseSession | None" = None
+_worker_threads = 1
+
+
+def _init_worker(use_rembg: bool, providers: list[str] | None, threads: int) -> None:
+    """
+    ProcessPoolExecutor initializer: cap this worker's inner threads (PNG saves, numba kernel,
+    ONNX Runtime via OMP_NUM_THREADS unless set) to threads, then load its rembg session once.
+    """
+    global _worker_rembg_session, _worker_threads
+    _worker_threads = threads
+    set_kernel_threads(threads)
+    if use_rembg:
+        os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+        _worker_rembg_session = new_rembg_session(providers)
+
+
+def _process_job(job: SheetJob) -> Path:
+    """Pool entry point: process_one(*job) with this worker's rembg session. Returns the input path."""
+    process_one(
+        *job,
+        rembg_session=_worker_rembg_session,
+        frame_progress=False,
+        save_threads=_worker_threads,
+    )
+    return job.input_path
+
+
 def main() -> None:
+    # numba's default TBB threading layer can hang interpreter exit once the ffmpeg writer has run.
+    # The CLI calls the kernel from one thread per process, where workqueue is safe; workers inherit it.
+    os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
     parser = argparse.ArgumentParser(
         description="Process sprite sheet(s): make background transparent and split into M×N frames. Batch: same grid/bg for all inputs."
     )
@@ -145,12 +239,29 @@ def main() -> None:
         action="store_true",
         help="Use rembg (AI) to remove background instead of solid-color removal.",
     )
+    parser.add_argument(
+        "--providers",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="EP",
+        help="ONNX Runtime execution providers for --rembg, in priority order (e.g. CUDAExecutionProvider CPUExecutionProvider). Default: CUDA / CoreML when available, else CPU.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Number of sheets processed in parallel (default: CPU count; 1 with --rembg, as each worker loads its own model). Always 1 with --rembg on CUDA.",
+    )
     parser.add_argument(
         "--bg",
         type=str,
+        action="append",
         default=None,
         metavar="HEX",
-        help='Background color as hex when not using --rembg (e.g. "#FFFFFF"). Required without --rembg.',
+        help='Background color as hex when not using --rembg (e.g. "#FFFFFF"). Repeat to key out several colors. Required without --rembg.',
     )
     parser.add_argument(
         "--tolerance",
@@ -173,6 +284,14 @@ def main() -> None:
         action="store_true",
         help="Also save the full sheet with transparent background",
     )
+    parser.add_argument(
+        "--compress-level",
+        type=int,
+        default=6,
+        choices=range(10),
+        metavar="L",
+        help="PNG zlib compression level 0-9 for frames and full sheet (default 6). Lower is faster but larger.",
+    )
     parser.add_argument(
         "--gif-duration",
         type=int,
@@ -214,17 +333,14 @@ def main() -> None:
     preview_duration_ms = int(max(1, args.gif_duration / max(0.1, args.preview_speed)))
 
     inputs = expand_inputs(args.input)
-    missing = [p for p in inputs if not p.is_file()]
-    if missing:
-        raise SystemExit(f"Input file(s) not found: {missing}")
 
     if not args.rembg and args.bg is None:
         raise SystemExit("Either --rembg or --bg HEX is required.")
 
-    bg_rgb: tuple[int, int, int] | None = None
+    bg_rgb: list[tuple[int, int, int]] | None = None
     if args.bg is not None:
         try:
-            bg_rgb = parse_hex_color(args.bg)
+            bg_rgb = [parse_hex_color(c) for c in args.bg]
         except ValueError as e:
             raise SystemExit(e)
 
@@ -233,15 +349,20 @@ def main() -> None:
 
     args.output.mkdir(parents=True, exist_ok=True)
 
-    iterator = (
-        tqdm(enumerate(inputs), total=len(inputs), desc="Sheets", unit="sheet")
-        if len(inputs) > 1
-        else enumerate(inputs)
-    )
-    for idx, input_path in iterator:
-        if len(inputs) > 1:
-            tqdm.write(f"[{idx + 1}/{len(inputs)}] {input_path.name}")
-        process_one(
+    if args.jobs is not None and args.jobs < 1:
+        raise SystemExit("--jobs must be >= 1.")
+
+    providers = resolve_rembg_providers(args.providers) if args.rembg else None
+    if args.jobs is not None:
+        workers = args.jobs
+    else:
+        workers = 1 if args.rembg else (os.cpu_count() or 1)
+    if providers is not None and "CUDAExecutionProvider" in providers:
+        workers = 1  # sheets would contend for the one GPU; frames already share its session
+    workers = min(workers, len(inputs))
+
+    jobs = [
+        SheetJob(
             input_path,
             args.output,
             rows,
@@ -253,7 +374,34 @@ def main() -> None:
             preview_duration_ms,
             args.preview_format,
             args.preview_checkerboard,
+            args.compress_level,
         )
+        for input_path in inputs
+    ]
+
+    if workers > 1:
+        # Split the CPUs between workers so inner thread pools do not grow with cpu_count².
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(args.rembg, providers, threads),
+        ) as ex:
+            for input_path in tqdm(ex.map(_process_job, jobs), total=len(jobs), desc="Sheets", unit="sheet"):
+                tqdm.write(f"Done: {input_path.name}")
+        return
+
+    rembg_session = new_rembg_session(providers) if args.rembg else None
+
+    iterator: Iterable[tuple[int, SheetJob]] = (
+        tqdm(enumerate(jobs), total=len(jobs), desc="Sheets", unit="sheet")
+        if len(jobs) > 1
+        else enumerate(jobs)
+    )
+    for idx, job in iterator:
+        if len(jobs) > 1:
+            tqdm.write(f"[{idx + 1}/{len(jobs)}] {job.input_path.name}")
+        process_one(*job, rembg_session=rembg_session)
 
 
 if __name__ == "__main__":
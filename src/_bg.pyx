@@ -0,0 +1,22 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Optional compiled kernel for make_background_transparent (used when built; else numba / NumPy).
+Build in place with:  CFLAGS="-O3 -march=native" cythonize -i src/_bg.pyx
+"""
+from libc.stdint cimport uint8_t
+
+
+def zero_bg(uint8_t[:, :, ::1] arr, int r0, int g0, int b0, int tol):
+    """Zero alpha in-place where RGB is within tol of (r0, g0, b0); one pass over the RGBA buffer."""
+    cdef Py_ssize_t i, n = arr.shape[0] * arr.shape[1]
+    cdef uint8_t* p
+    if arr.shape[2] != 4:
+        raise ValueError(f"zero_bg expects an (H, W, 4) RGBA array, got {arr.shape[2]} channels")
+    if n == 0:
+        return
+    p = &arr[0, 0, 0]
+    with nogil:
+        for i in range(n):
+            if abs(<int>p[0] - r0) <= tol and abs(<int>p[1] - g0) <= tol and abs(<int>p[2] - b0) <= tol:
+                p[3] = 0
+            p += 4
@@ -4,54 +4,198 @@ Preview export: GIF, APNG, MP4; optional checkerboard background.
 """
 from __future__ import annotations
 
+import math
+import shutil
+import subprocess
+import threading
+from collections.abc import Callable, Iterable, Sequence
 from pathlib import Path
-from typing import cast
+from types import ModuleType
+from typing import TYPE_CHECKING, cast
 
 import numpy as np
 from PIL import Image
 
+if TYPE_CHECKING:
+    from rembg.sessions.base import BaseSession
 
-def remove_background_rembg(image: Image.Image) -> Image.Image:
-    """
-    Remove background using rembg (AI-based). Returns RGBA with transparent background.
-    Requires: pip install rembg (Python 3.11+).
-    """
+# numba is optional and slow to import and compile (about 0.2 s per process with a warm cache), so
+# its kernel is loaded on first use, only for sheets of at least _BGZERO_MIN_PIXELS; smaller use NumPy.
+_BGZERO_MIN_PIXELS = 1 << 22
+# Held while loading or calling the kernel: numba's workqueue threading layer aborts on concurrent calls.
+_bgzero_lock = threading.Lock()
+_bgzero: Callable[[np.ndarray, int, int, int, int], None] | None = None
+_bgzero_loaded = False
+_kernel_threads: int | None = None
+
+
+def _load_bgzero() -> Callable[[np.ndarray, int, int, int, int], None] | None:
+    """Import numba and build the background kernel once (call with _bgzero_lock held); None without numba."""
+    global _bgzero, _bgzero_loaded
+    if _bgzero_loaded:
+        return _bgzero
+    _bgzero_loaded = True
+    try:
+        import numba
+        from numba import prange
+    except ImportError:  # numba is optional; make_background_transparent falls back to NumPy
+        return None
+
+    @numba.njit(parallel=True, cache=True)
+    def bgzero(arr, r0, g0, b0, tol):  # type: ignore[no-untyped-def]
+        """Zero alpha in-place where RGB is within tol of (r0, g0, b0); one fused pass over arr."""
+        for y in prange(arr.shape[0]):
+            for x in range(arr.shape[1]):
+                if (
+                    abs(int(arr[y, x, 0]) - r0) <= tol
+                    and abs(int(arr[y, x, 1]) - g0) <= tol
+                    and abs(int(arr[y, x, 2]) - b0) <= tol
+                ):
+                    arr[y, x, 3] = 0
+
+    _bgzero = bgzero
+    if _kernel_threads is not None:
+        _set_numba_threads(_kernel_threads)
+    return _bgzero
+
+
+def _set_numba_threads(n: int) -> None:
+    """numba.set_num_threads(n), clamped to the threads numba was started with."""
+    import numba
+
+    numba.set_num_threads(max(1, min(n, numba.config.NUMBA_NUM_THREADS)))  # type: ignore[attr-defined]
+
+
+try:
+    from ._bg import zero_bg as _zero_bg_c  # type: ignore[import-not-found]
+except ImportError:  # optional Cython kernel, only present when src/_bg.pyx has been built
+    _zero_bg_c = None
+
+
+def set_kernel_threads(n: int) -> None:
+    """Cap the threads used by the numba background kernel (applied when it loads; no-op without numba)."""
+    global _kernel_threads
+    with _bgzero_lock:
+        _kernel_threads = n
+        if _bgzero is not None:
+            _set_numba_threads(n)
+
+
+def _import_rembg() -> ModuleType:
+    """Import rembg lazily (optional, heavy); RuntimeError with install hint if missing."""
     try:
-        from rembg import remove as rembg_remove
+        import rembg
     except ImportError as e:
         raise RuntimeError(
             "rembg is not installed. Install with: pip install rembg  (requires Python 3.11+)"
         ) from e
-    out = cast(Image.Image, rembg_remove(image))
+    return rembg
+
+
+# ONNX Runtime execution providers tried in order; GPU first, CPU always last.
+DEFAULT_REMBG_PROVIDERS = ("CUDAExecutionProvider", "CoreMLExecutionProvider", "CPUExecutionProvider")
+
+
+def resolve_rembg_providers(providers: list[str] | None = None) -> list[str]:
+    """
+    Execution providers a rembg session will be created with. providers is returned as-is;
+    None means those of DEFAULT_REMBG_PROVIDERS that this onnxruntime build offers.
+    """
+    if providers is not None:
+        return providers
+    _import_rembg()  # onnxruntime ships with rembg; same install hint if missing
+    import onnxruntime as ort
+
+    available = set(ort.get_available_providers())
+    return [p for p in DEFAULT_REMBG_PROVIDERS if p in available] or ["CPUExecutionProvider"]
+
+
+def new_rembg_session(providers: list[str] | None = None) -> BaseSession:
+    """
+    Create a rembg session (loads the ONNX model). Reuse it across frames and sheets
+    by passing it as session= to remove_background_rembg / remove_background_rembg_batch.
+    providers: ONNX Runtime execution providers in priority order. Default: those of
+    DEFAULT_REMBG_PROVIDERS that this onnxruntime build offers, so a GPU is used when present.
+    """
+    rembg = _import_rembg()
+    return cast("BaseSession", rembg.new_session(providers=resolve_rembg_providers(providers)))
+
+
+def remove_background_rembg(
+    image: Image.Image,
+    session: BaseSession | None = None,
+) -> Image.Image:
+    """
+    Remove background using rembg (AI-based). Returns RGBA with transparent background.
+    session: from new_rembg_session(); if None, rembg creates one (and loads the model) per call.
+    Requires: pip install rembg (Python 3.11+).
+    """
+    out = cast(Image.Image, _import_rembg().remove(image, session=session))
     return out.convert("RGBA") if out.mode != "RGBA" else out
 
 
+def remove_background_rembg_batch(
+    frames: Iterable[Image.Image],
+    session: BaseSession | None = None,
+) -> list[Image.Image]:
+    """
+    Remove background from many frames with one rembg session (model loaded once).
+    session: from new_rembg_session(); if None, a new session is created for this batch.
+    Returns RGBA frames in input order. Requires: pip install rembg (Python 3.11+).
+    """
+    # rembg preprocessing is model-specific and predicts one image per run, so frames
+    # cannot be stacked into one tensor through its API; sharing the session is the batch win.
+    if session is None:
+        session = new_rembg_session()
+    return [remove_background_rembg(f, session) for f in frames]
+
+
 def make_background_transparent(
     image: Image.Image,
-    bg_rgb: tuple[int, int, int],
+    bg_rgb: tuple[int, int, int] | Sequence[tuple[int, int, int]],
     tolerance: int = 0,
 ) -> Image.Image:
     """
-    Make pixels close to bg_rgb transparent by setting their alpha to 0.
+    Make pixels close to bg_rgb transparent by setting their alpha to 0. Accepts any mode
+    (existing transparency is kept); returns a new RGBA image and leaves image unchanged.
+    bg_rgb: one (r, g, b) color, or several to key out all of them.
     Only alpha is changed; RGB is unchanged for smooth edges.
+    tolerance=0 matches exact colors on packed 32-bit pixels; otherwise the compiled src/_bg.pyx
+    kernel is used when built, else (for large sheets) a fused numba kernel when numba is installed,
+    else NumPy.
     """
-    img = image.convert("RGBA")
-    r0, g0, b0 = bg_rgb
-    data = img.getdata()
-    new_data: list[tuple[int, int, int, int]] = []
-    for raw in data:
-        item = cast(tuple[int, int, int, int], raw)
-        r, g, b, a = item
-        if (
-            abs(r - r0) <= tolerance
-            and abs(g - g0) <= tolerance
-            and abs(b - b0) <= tolerance
-        ):
-            new_data.append((r, g, b, 0))
-        else:
-            new_data.append(item)
-    img.putdata(new_data)
-    return img
+    colors = cast(list[tuple[int, int, int]], [bg_rgb] if isinstance(bg_rgb[0], int) else list(bg_rgb))
+    rgba = image if image.mode == "RGBA" else image.convert("RGBA")
+    arr = np.array(rgba, dtype=np.uint8)
+    if tolerance == 0:
+        # Exact match: one 32-bit compare per pixel on the packed RGBA word, alpha masked out.
+        # Keys and mask are built from bytes so the comparison is byte-order independent.
+        words = arr.view(np.uint32)[..., 0]
+        rgb_mask = np.array([0xFF, 0xFF, 0xFF, 0], dtype=np.uint8).view(np.uint32)[0]
+        keys = np.array([(*c, 0) for c in colors], dtype=np.uint8).view(np.uint32)[:, 0]
+        rgb_words = words & rgb_mask
+        mask = rgb_words == keys[0] if len(keys) == 1 else np.isin(rgb_words, keys)
+        arr[..., 3][mask] = 0
+    elif _zero_bg_c is not None:
+        for r0, g0, b0 in colors:
+            _zero_bg_c(arr, r0, g0, b0, tolerance)
+    else:
+        kernel = None
+        if arr.shape[0] * arr.shape[1] >= _BGZERO_MIN_PIXELS:
+            with _bgzero_lock:
+                kernel = _load_bgzero()
+                if kernel is not None:
+                    for r0, g0, b0 in colors:
+                        kernel(arr, r0, g0, b0, tolerance)
+        if kernel is None:
+            rgb = arr[:, :, :3].astype(np.int16)
+            mask = np.zeros(arr.shape[:2], dtype=bool)
+            for c in colors:
+                mask |= np.abs(rgb - np.array(c, dtype=np.int16)).max(axis=2) <= tolerance
+            arr[..., 3][mask] = 0
+    # arr is C-contiguous RGBA, so fromarray maps it via frombuffer without a copy
+    # (no per-pixel putdata / tobytes round-trip).
+    return Image.fromarray(arr)
 
 
 def split_into_frames(
@@ -84,24 +228,42 @@ def _checkerboard(size: tuple[int, int], tile_size: int = 8) -> Image.Image:
     w, h = size
     tile = tile_size
     # Two colors: #e0e0e0 and #ffffff
-    c1, c2 = (0xE0, 0xE0, 0xE0), (0xFF, 0xFF, 0xFF)
-    out = Image.new("RGB", size)
-    px = out.load()
-    assert px is not None  # PIL load() returns PixelAccess for new images
-    for y in range(h):
-        for x in range(w):
-            ix, iy = x // tile, y // tile
-            px[x, y] = c1 if ((ix + iy) % 2 == 0) else c2
-    return out
+    colors = np.array([(0xE0, 0xE0, 0xE0), (0xFF, 0xFF, 0xFF)], dtype=np.uint8)
+    ix = np.arange(w) // tile
+    iy = np.arange(h) // tile
+    parity = (iy[:, None] + ix[None, :]) & 1
+    return Image.fromarray(colors[parity])
 
 
-def _composite_on_checkerboard(frame: Image.Image, tile_size: int = 8) -> Image.Image:
-    """Composite RGBA frame onto checkerboard; returns RGB."""
+def _composite_on_checkerboard(
+    frame: Image.Image,
+    tile_size: int = 8,
+    board: Image.Image | None = None,
+) -> Image.Image:
+    """
+    Composite RGBA frame onto checkerboard; returns RGB.
+    board: prebuilt checkerboard of frame.size to reuse (left unmodified).
+    """
     if frame.mode != "RGBA":
         frame = frame.convert("RGBA")
-    bg = _checkerboard(frame.size, tile_size)
+    bg = board.copy() if board is not None else _checkerboard(frame.size, tile_size)
     bg.paste(frame, (0, 0), frame)
-    return bg.convert("RGB")
+    return bg
+
+
+def _composite_frames_on_checkerboard(
+    frames: list[Image.Image],
+    tile_size: int = 8,
+) -> list[Image.Image]:
+    """Composite frames onto checkerboards built once per frame size (frames usually share one)."""
+    boards: dict[tuple[int, int], Image.Image] = {}
+    out: list[Image.Image] = []
+    for f in frames:
+        board = boards.get(f.size)
+        if board is None:
+            board = boards[f.size] = _checkerboard(f.size, tile_size)
+        out.append(_composite_on_checkerboard(f, tile_size, board))
+    return out
 
 
 def _composite_on_white(frame: Image.Image) -> Image.Image:
@@ -113,23 +275,71 @@ def _composite_on_white(frame: Image.Image) -> Image.Image:
     return bg
 
 
+# Pixels sampled (at most, roughly) to build a GIF's shared palette.
+_PALETTE_SAMPLE = 1 << 18
+
+
+def _quantize_shared_palette(frames: list[Image.Image]) -> tuple[list[Image.Image], bytes, int]:
+    """
+    Quantize frames to P mode against one palette built from all frames' opaque pixels
+    (up to 255 colors, fast octree on a grid subsample). Pixels with alpha < 128 map to one extra
+    transparent entry. Returns (frames, palette bytes, transparent index).
+    Frames are converted to arrays one at a time, so no second RGBA copy of the list is held.
+    """
+    # Every s-th row and column, so the palette costs about the same for any frame count or size.
+    s = max(1, math.isqrt(sum(f.width * f.height for f in frames) // _PALETTE_SAMPLE))
+    samples = []
+    for f in frames:
+        t = np.asarray(f.convert("RGBA") if f.mode != "RGBA" else f)[::s, ::s]
+        samples.append(t[t[..., 3] >= 128][:, :3])
+    opaque = np.concatenate(samples)
+    if not len(opaque):
+        opaque = np.zeros((1, 3), dtype=np.uint8)
+    master = Image.fromarray(opaque[None]).quantize(
+        colors=255, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE
+    )
+    flat = cast(list[int], master.getpalette())
+    colors = list(dict.fromkeys(zip(flat[0::3], flat[1::3], flat[2::3])))[:255]
+    # Opaque pixels are matched against the real colors only; the transparent entry is appended
+    # after them with an unused gray so every palette entry stays distinct.
+    lookup = Image.new("P", (1, 1))
+    lookup.putpalette([v for c in colors for v in c])
+    transparent = len(colors)
+    key = next((i, i, i) for i in range(256) if (i, i, i) not in colors)
+    palette = bytes(v for c in [*colors, key] for v in c)
+    out: list[Image.Image] = []
+    for f in frames:
+        rgba = f.convert("RGBA") if f.mode != "RGBA" else f
+        idx = np.array(rgba.convert("RGB").quantize(palette=lookup, dither=Image.Dither.NONE))
+        idx[np.asarray(rgba.getchannel("A")) < 128] = transparent
+        p = Image.fromarray(idx, "P")
+        p.putpalette(palette)
+        out.append(p)
+    return out, palette, transparent
+
+
 def frames_to_gif(
     frames: list[Image.Image],
     path: Path | str,
     duration_ms: int = 100,
     checkerboard: bool = False,
+    gifsicle: bool = True,
 ) -> None:
     """
     Save RGBA frames as animated GIF. disposal=2 so each frame replaces the previous.
+    All frames share one palette (quantized once across frames) stored as the global color table.
     If checkerboard=True, composite each frame on a checkerboard background (no transparency in output).
+    If gifsicle=True and gifsicle is on PATH, the file is then optimized in place with gifsicle -O3.
     """
     if not frames:
         return
     path = Path(path)
     if checkerboard:
-        frames = [_composite_on_checkerboard(f) for f in frames]
+        frames = _composite_frames_on_checkerboard(frames)
+    frames, palette, transparent = _quantize_shared_palette(frames)
     first = frames[0]
     rest = frames[1:]
+    # palette= makes Pillow write the shared palette once as the global color table.
     first.save(
         path,
         save_all=True,
@@ -137,7 +347,14 @@ def frames_to_gif(
         duration=duration_ms,
         loop=0,
         disposal=2,
+        palette=palette,
+        transparency=transparent,
+        optimize=False,
     )
+    exe = shutil.which("gifsicle") if gifsicle else None
+    if exe is not None:
+        # Optional post-pass: smaller LZW output; on failure the Pillow-written file is kept.
+        subprocess.run([exe, "-O3", "--batch", str(path)], check=False, capture_output=True)
 
 
 def frames_to_apng(
@@ -146,29 +363,24 @@ def frames_to_apng(
     duration_ms: int = 100,
     checkerboard: bool = False,
 ) -> None:
-    """Save RGBA frames as APNG. Requires: pip install apng."""
+    """Save RGBA frames as APNG (Pillow's native APNG writer), looping forever."""
     if not frames:
         return
     path = Path(path)
     if checkerboard:
-        frames = [_composite_on_checkerboard(f) for f in frames]
+        frames = _composite_frames_on_checkerboard(frames)
     else:
         frames = [f.convert("RGBA") if f.mode != "RGBA" else f for f in frames]
-    try:
-        import apng
-    except ImportError as e:
-        raise RuntimeError("apng is not installed. Install with: pip install apng") from e
-    import tempfile
-    with tempfile.TemporaryDirectory() as tmp:
-        files = [Path(tmp) / f"f{i}.png" for i in range(len(frames))]
-        for f, p in zip(frames, files):
-            f.save(str(p), "PNG")
-        # delay: delay_num/delay_den = seconds (APNG fcTL); 100ms = 10/100 s
-        delay_cs = max(1, round(duration_ms / 10))
-        im = apng.APNG(num_plays=0)  # 0 = loop forever
-        for p in files:
-            im.append_file(str(p), delay=delay_cs, delay_den=100)
-        im.save(str(path))
+    first = frames[0]
+    rest = frames[1:]
+    first.save(
+        path,
+        format="PNG",
+        save_all=True,
+        append_images=rest,
+        duration=duration_ms,
+        loop=0,
+    )
 
 
 def frames_to_mp4(
@@ -177,24 +389,40 @@ def frames_to_mp4(
     duration_ms: int = 100,
     checkerboard: bool = False,
 ) -> None:
-    """Save RGBA frames as MP4. Requires: pip install imageio imageio-ffmpeg."""
+    """
+    Save RGBA frames as MP4 (H.264, yuv420p). Requires: pip install imageio imageio-ffmpeg.
+    All frames must have the same size; they are composited into one preallocated buffer.
+    """
     if not frames:
         return
     path = Path(path)
-    if checkerboard:
-        frames = [_composite_on_checkerboard(f) for f in frames]
-    else:
-        frames = [f.convert("RGB") if f.mode != "RGBA" else _composite_on_white(f) for f in frames]
     try:
         import imageio
     except ImportError as e:
         raise RuntimeError(
             "imageio is not installed. Install with: pip install imageio imageio-ffmpeg"
         ) from e
+    w, h = frames[0].size
+    board = _checkerboard((w, h)) if checkerboard else None
+    buf = np.empty((len(frames), h, w, 3), dtype=np.uint8)
+    for i, f in enumerate(frames):
+        if board is not None:
+            rgb = _composite_on_checkerboard(f, board=board)
+        else:
+            rgb = f.convert("RGB") if f.mode != "RGBA" else _composite_on_white(f)
+        np.copyto(buf[i], np.asarray(rgb))
     fps = 1000.0 / max(1, duration_ms)
-    arrays = [np.asarray(f) for f in frames]
-    # Explicit format so imageio uses FFmpeg for .mp4 (avoids wrong plugin selection)
-    writer = imageio.get_writer(str(path), format="FFMPEG", fps=fps, codec="libx264")  # type: ignore[arg-type]
-    for arr in arrays:
-        writer.append_data(arr)
+    # Explicit format so imageio uses FFmpeg for .mp4 (avoids wrong plugin selection).
+    # macro_block_size=2: yuv420p only needs even sizes, so most frames skip imageio's resize.
+    writer = imageio.get_writer(  # type: ignore[arg-type]
+        str(path),
+        format="FFMPEG",
+        fps=fps,
+        codec="libx264",
+        pixelformat="yuv420p",
+        macro_block_size=2,
+        ffmpeg_params=["-preset", "ultrafast"],
+    )
+    for frame in buf:
+        writer.append_data(frame)
     writer.close()